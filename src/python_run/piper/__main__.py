@@ -4,10 +4,9 @@ import sys
 import time
 import wave
 from pathlib import Path
-from typing import Any, Dict
 
 from . import PiperVoice
-from .download import ensure_voice_exists, find_voice, get_voices
+from .download import add_voice_aliases, ensure_voice_exists, find_voice, get_voices
 
 _FILE = Path(__file__)
 _DIR = _FILE.parent
@@ -92,15 +91,9 @@ def main() -> None:
     model_path = Path(args.model)
     if not model_path.exists():
         # Load voice info
-        voices_info = get_voices(args.download_dir, update_voices=args.update_voices)
-
-        # Resolve aliases for backwards compatibility with old voice names
-        aliases_info: Dict[str, Any] = {}
-        for voice_info in voices_info.values():
-            for voice_alias in voice_info.get("aliases", []):
-                aliases_info[voice_alias] = {"_is_alias": True, **voice_info}
-
-        voices_info.update(aliases_info)
+        voices_info = add_voice_aliases(
+            get_voices(args.download_dir, update_voices=args.update_voices)
+        )
         ensure_voice_exists(args.model, args.data_dir, args.download_dir, voices_info)
         args.model, args.config = find_voice(args.model, args.data_dir)
 
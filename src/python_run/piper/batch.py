@@ -0,0 +1,153 @@
+"""Batching of concurrent synthesis jobs."""
+import logging
+import math
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from .metrics import BATCH_SIZE, BATCH_TRIM_FAILURES, SYNTH_SECONDS
+from .voice import PiperVoice
+
+_LOGGER = logging.getLogger(__name__)
+
+# Sentences in a batch are padded to the longest one, and some of the audio
+# generated for padding is left on the shorter ones. Only phoneme lengths
+# within a factor of sqrt(2) share a batch to keep that small.
+_LENGTH_BUCKETS_PER_OCTAVE = 2
+
+
+def _length_bucket(num_phoneme_ids: int) -> int:
+    return int(math.log2(max(1, num_phoneme_ids)) * _LENGTH_BUCKETS_PER_OCTAVE)
+
+
+@dataclass
+class _BatchItem:
+    voice: PiperVoice
+    phoneme_ids: List[int]
+    speaker_id: Optional[int]
+    length_scale: Optional[float]
+    noise_scale: Optional[float]
+    noise_w: Optional[float]
+    future: "Future[bytes]" = field(default_factory=Future)
+
+    def can_batch_with(self, other: "_BatchItem") -> bool:
+        """True if both items can share one inference run."""
+        return (
+            (self.voice is other.voice)
+            and (self.speaker_id == other.speaker_id)
+            and (self.length_scale == other.length_scale)
+            and (self.noise_scale == other.noise_scale)
+            and (self.noise_w == other.noise_w)
+            and (
+                _length_bucket(len(self.phoneme_ids))
+                == _length_bucket(len(other.phoneme_ids))
+            )
+        )
+
+
+class BatchScheduler:
+    """Coalesces concurrent synthesis jobs into batched inference runs.
+
+    Jobs are collected for up to max_wait_seconds after the first one arrives,
+    and jobs with the same voice and settings and a similar number of phonemes
+    are run together (up to max_batch_size at a time) on a single worker
+    thread.
+    """
+
+    def __init__(self, max_batch_size: int, max_wait_seconds: float) -> None:
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_seconds
+        self._queue: "queue.Queue[_BatchItem]" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(
+        self,
+        voice: PiperVoice,
+        phoneme_ids: List[int],
+        speaker_id: Optional[int] = None,
+        length_scale: Optional[float] = None,
+        noise_scale: Optional[float] = None,
+        noise_w: Optional[float] = None,
+    ) -> "Future[bytes]":
+        """Queue phoneme ids for synthesis. The future resolves to raw audio."""
+        item = _BatchItem(
+            voice=voice,
+            phoneme_ids=phoneme_ids,
+            speaker_id=speaker_id,
+            length_scale=length_scale,
+            noise_scale=noise_scale,
+            noise_w=noise_w,
+        )
+        self._queue.put(item)
+
+        return item.future
+
+    def _run(self) -> None:
+        # Items that arrived while a batch with other settings was collected
+        waiting: List[_BatchItem] = []
+
+        while True:
+            first = waiting.pop(0) if waiting else self._queue.get()
+            batch = [first]
+            for item in list(waiting):
+                if len(batch) >= self.max_batch_size:
+                    break
+
+                if item.can_batch_with(first):
+                    batch.append(item)
+                    waiting.remove(item)
+
+            deadline = time.monotonic() + self.max_wait_seconds
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+
+                if item.can_batch_with(first):
+                    batch.append(item)
+                else:
+                    waiting.append(item)
+
+            self._run_batch(batch)
+
+    def _run_batch(self, batch: List[_BatchItem]) -> None:
+        first = batch[0]
+        synthesize_args: Dict[str, Any] = {
+            "speaker_id": first.speaker_id,
+            "length_scale": first.length_scale,
+            "noise_scale": first.noise_scale,
+            "noise_w": first.noise_w,
+        }
+
+        BATCH_SIZE.observe(len(batch))
+        try:
+            with SYNTH_SECONDS.time():
+                if len(batch) == 1:
+                    results = [
+                        first.voice.synthesize_ids_to_raw(
+                            first.phoneme_ids, **synthesize_args
+                        )
+                    ]
+                else:
+                    _LOGGER.debug("Synthesizing batch of %s", len(batch))
+                    results, num_untrimmed = first.voice.synthesize_ids_to_raw_batch(
+                        [item.phoneme_ids for item in batch], **synthesize_args
+                    )
+                    BATCH_TRIM_FAILURES.inc(num_untrimmed)
+        except Exception as err:
+            for item in batch:
+                item.future.set_exception(err)
+
+            return
+
+        for item, audio_bytes in zip(batch, results):
+            item.future.set_result(audio_bytes)
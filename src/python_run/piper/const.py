@@ -3,3 +3,5 @@
 PAD = "_"  # padding (0)
 BOS = "^"  # beginning of sentence
 EOS = "$"  # end of sentence
+
+HOP_LENGTH = 256  # audio samples per decoder frame
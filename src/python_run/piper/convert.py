@@ -0,0 +1,251 @@
+"""Conversions of voice models for faster inference."""
+import logging
+import os
+import shutil
+import tempfile
+from itertools import chain
+from pathlib import Path
+from typing import Dict, List, Set, Union
+
+_LOGGER = logging.getLogger(__name__)
+
+# Operators in the HiFi-GAN decoder that are safe to run in float16
+_FP16_OPS = {
+    "Add",
+    "Concat",
+    "Conv",
+    "ConvTranspose",
+    "Div",
+    "Identity",
+    "LeakyRelu",
+    "Mul",
+    "Pad",
+    "Reshape",
+    "Slice",
+    "Squeeze",
+    "Sub",
+    "Tanh",
+    "Transpose",
+    "Unsqueeze",
+}
+
+
+def _is_up_to_date(converted_path: Path, model_path: Path) -> bool:
+    return (
+        converted_path.exists()
+        and converted_path.stat().st_mtime >= model_path.stat().st_mtime
+    )
+
+
+def convert_to_fp16(model_path: Union[str, Path]) -> Path:
+    """Convert the audio decoder of a voice model to float16.
+
+    Only the decoder (everything downstream of its upsampling layers) is
+    converted. The text encoder, duration predictor, and flow stay in float32,
+    as do the model's inputs and outputs.
+
+    The converted model is cached in an fp16 directory next to the original.
+    Requires the onnx package.
+    """
+    model_path = Path(model_path)
+    fp16_path = model_path.parent / "fp16" / model_path.name
+    if _is_up_to_date(fp16_path, model_path):
+        return fp16_path
+
+    import onnx
+    from onnx import TensorProto, helper, numpy_helper
+
+    _LOGGER.debug("Converting decoder of %s to float16", model_path)
+    model = onnx.load(str(model_path))
+    graph = model.graph
+
+    inferred_graph = onnx.shape_inference.infer_shapes(model).graph
+    float_names: Set[str] = {
+        value_info.name
+        for value_info in chain(
+            inferred_graph.value_info, inferred_graph.input, inferred_graph.output
+        )
+        if value_info.type.tensor_type.elem_type == TensorProto.FLOAT
+    }
+    float_names.update(
+        init.name for init in graph.initializer if init.data_type == TensorProto.FLOAT
+    )
+
+    # Nodes are identified by index, since names may be empty or repeated
+    nodes = list(graph.node)
+    consumers: Dict[str, List[int]] = {}
+    for node_idx, node in enumerate(nodes):
+        for input_name in node.input:
+            consumers.setdefault(input_name, []).append(node_idx)
+
+    # Decoder nodes are reachable from the upsampling layers through safe ops
+    fp16_nodes: Set[int] = set()
+    pending = [
+        node_idx
+        for node_idx, node in enumerate(nodes)
+        if node.op_type == "ConvTranspose"
+    ]
+    while pending:
+        node_idx = pending.pop()
+        if (node_idx in fp16_nodes) or (nodes[node_idx].op_type not in _FP16_OPS):
+            continue
+
+        fp16_nodes.add(node_idx)
+        for output_name in nodes[node_idx].output:
+            pending.extend(consumers.get(output_name, []))
+
+    if not fp16_nodes:
+        raise ValueError(f"No decoder found in {model_path}")
+
+    fp16_outputs = {
+        output_name
+        for node_idx in fp16_nodes
+        for output_name in nodes[node_idx].output
+        if output_name in float_names
+    }
+    graph_outputs = {output.name for output in graph.output}
+
+    # Weights used only by the decoder are stored as float16
+    initializers = {init.name: init for init in graph.initializer}
+    converted_inits: Set[str] = set()
+    for name, init in initializers.items():
+        users = consumers.get(name, [])
+        if (
+            (name in float_names)
+            and users
+            and all(user_idx in fp16_nodes for user_idx in users)
+        ):
+            init.CopyFrom(
+                numpy_helper.from_array(
+                    numpy_helper.to_array(init).astype("float16"), name
+                )
+            )
+            converted_inits.add(name)
+
+    # Cast float32 values entering the decoder, and decoder values leaving it
+    new_nodes = []
+    cast_inputs: Dict[str, str] = {}
+    for node_idx, node in enumerate(nodes):
+        if node_idx not in fp16_nodes:
+            new_nodes.append(node)
+            continue
+
+        cast_prefix = f"{node.name or node.op_type}_{node_idx}"
+
+        for i, input_name in enumerate(node.input):
+            if (
+                (input_name not in float_names)
+                or (input_name in fp16_outputs)
+                or (input_name in converted_inits)
+            ):
+                continue
+
+            if input_name not in cast_inputs:
+                cast_inputs[input_name] = f"{input_name}_fp16"
+                new_nodes.append(
+                    helper.make_node(
+                        "Cast",
+                        [input_name],
+                        [cast_inputs[input_name]],
+                        name=f"{cast_prefix}_{i}_to_fp16",
+                        to=TensorProto.FLOAT16,
+                    )
+                )
+
+            node.input[i] = cast_inputs[input_name]
+
+        new_nodes.append(node)
+
+        for i, output_name in enumerate(node.output):
+            if output_name not in fp16_outputs:
+                continue
+
+            outside_users = [
+                user_idx
+                for user_idx in consumers.get(output_name, [])
+                if user_idx not in fp16_nodes
+            ]
+            if (not outside_users) and (output_name not in graph_outputs):
+                continue
+
+            # Decoder users read the float16 value, everything else the cast
+            fp16_name = f"{output_name}_fp16"
+            node.output[i] = fp16_name
+            for user_idx in consumers.get(output_name, []):
+                if user_idx in fp16_nodes:
+                    user = nodes[user_idx]
+                    for j, user_input in enumerate(user.input):
+                        if user_input == output_name:
+                            user.input[j] = fp16_name
+
+            new_nodes.append(
+                helper.make_node(
+                    "Cast",
+                    [fp16_name],
+                    [output_name],
+                    name=f"{cast_prefix}_{i}_to_fp32",
+                    to=TensorProto.FLOAT,
+                )
+            )
+
+    del graph.node[:]
+    graph.node.extend(new_nodes)
+
+    # Let onnxruntime re-infer intermediate types
+    del graph.value_info[:]
+
+    # Write atomically, since several server processes may convert at once
+    fp16_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = fp16_path.with_name(f"{fp16_path.name}.{os.getpid()}.tmp")
+    onnx.save(model, str(temp_path))
+    os.replace(temp_path, fp16_path)
+    _LOGGER.info("Wrote %s", fp16_path)
+
+    return fp16_path
+
+
+def convert_to_external_data(model_path: Union[str, Path]) -> Path:
+    """Move the weights of a voice model into a separate data file.
+
+    onnxruntime memory-maps external weights instead of copying them out of
+    the model file, so server processes loading the same voice share one copy
+    in the page cache.
+
+    The converted model is cached in an external directory next to the
+    original, with its weights in <model>.data. Requires the onnx package.
+    """
+    model_path = Path(model_path)
+    external_path = model_path.parent / "external" / model_path.name
+    if _is_up_to_date(external_path, model_path):
+        return external_path
+
+    import onnx
+
+    _LOGGER.debug("Moving weights of %s to external data", model_path)
+    model = onnx.load(str(model_path))
+    data_name = f"{model_path.name}.data"
+
+    # Write atomically, since several server processes may convert at once.
+    # Weights are replaced before the model that references them.
+    external_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_dir = Path(tempfile.mkdtemp(dir=external_path.parent))
+    try:
+        onnx.save(
+            model,
+            str(temp_dir / model_path.name),
+            save_as_external_data=True,
+            all_tensors_to_one_file=True,
+            location=data_name,
+            size_threshold=1024,
+        )
+        # No data file is written if every tensor is under the size threshold
+        if (temp_dir / data_name).exists():
+            os.replace(temp_dir / data_name, external_path.parent / data_name)
+
+        os.replace(temp_dir / model_path.name, external_path)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    _LOGGER.info("Wrote %s", external_path)
+
+    return external_path
@@ -45,6 +45,17 @@ def get_voices(
         return json.load(voices_file)
 
 
+def add_voice_aliases(voices_info: Dict[str, Any]) -> Dict[str, Any]:
+    """Adds old voice names for backwards compatibility."""
+    aliases_info: Dict[str, Any] = {}
+    for voice_info in voices_info.values():
+        for voice_alias in voice_info.get("aliases", []):
+            aliases_info[voice_alias] = {"_is_alias": True, **voice_info}
+
+    voices_info.update(aliases_info)
+    return voices_info
+
+
 def ensure_voice_exists(
     name: str,
     data_dirs: Iterable[Union[str, Path]],
@@ -1,19 +1,235 @@
 #!/usr/bin/env python3
 import argparse
-import io
+import hashlib
 import json
 import logging
-import wave
+import os
+import struct
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
 
-from flask import Flask, request, jsonify
+import numpy as np
+import onnxruntime
+from flask import Flask, Response, jsonify, request
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
 
 from . import PiperVoice
-from .download import ensure_voice_exists, find_voice, get_voices
+from .batch import BatchScheduler
+from .convert import convert_to_external_data, convert_to_fp16
+from .download import (
+    VoiceNotFoundError,
+    add_voice_aliases,
+    ensure_voice_exists,
+    find_voice,
+    get_voices,
+)
+from .metrics import (
+    CACHE_HITS,
+    CACHE_MISSES,
+    MODEL_LOAD_SECONDS,
+    SYNTH_SECONDS,
+    clear_multiprocess_dir,
+    generate_metrics,
+    is_multiprocess,
+    mark_process_dead,
+)
+from .util import get_hybrid_cores, resample_audio
 
 _LOGGER = logging.getLogger()
 
+# RIFF/data size for a stream whose length isn't known up front
+_WAV_UNKNOWN_SIZE = 0xFFFFFFFF
+
+
+def wav_header(sample_rate: int, num_data_bytes: Optional[int] = None) -> bytes:
+    """Header for 16-bit mono PCM WAV data."""
+    if num_data_bytes is None:
+        riff_size = data_size = _WAV_UNKNOWN_SIZE
+    else:
+        riff_size, data_size = 36 + num_data_bytes, num_data_bytes
+
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF",
+        riff_size,
+        b"WAVE",
+        b"fmt ",
+        16,  # fmt chunk size
+        1,  # PCM
+        1,  # mono
+        sample_rate,
+        sample_rate * 2,  # byte rate
+        2,  # block align
+        16,  # bits per sample
+        b"data",
+        data_size,
+    )
+
+
+def _orjson_default(obj: Any) -> Any:
+    """Serialize types orjson doesn't support the way Flask does."""
+    return DefaultJSONProvider.default(obj)
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson."""
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj, default=_orjson_default).decode("utf-8")
+
+    def loads(self, s: Union[str, bytes], **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+
+class AudioCache:
+    """Thread-safe LRU cache of synthesized WAV bytes."""
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self._items: "OrderedDict[str, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(params: Dict[str, Any]) -> str:
+        """Content address for a set of synthesis parameters (including text)."""
+        if orjson is not None:
+            params_bytes = orjson.dumps(params, option=orjson.OPT_SORT_KEYS)
+        else:
+            params_bytes = json.dumps(
+                params, sort_keys=True, ensure_ascii=False
+            ).encode("utf-8")
+
+        return hashlib.sha256(params_bytes).hexdigest()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            wav_bytes = self._items.get(key)
+            if wav_bytes is not None:
+                self._items.move_to_end(key)
+
+            return wav_bytes
+
+    def put(self, key: str, wav_bytes: bytes) -> None:
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            self._items[key] = wav_bytes
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+
+class ModelList:
+    """Names of the voices in a set of directories.
+
+    Each directory is only re-scanned when its modification time changes.
+    """
+
+    def __init__(self, data_dirs: Iterable[Union[str, Path]]) -> None:
+        self.data_dirs = [Path(data_dir) for data_dir in data_dirs]
+        self._scans: Dict[Path, Tuple[int, List[str]]] = {}
+        self._lock = threading.Lock()
+
+    def get(self) -> List[str]:
+        names: Set[str] = set()
+        with self._lock:
+            for data_dir in self.data_dirs:
+                try:
+                    mtime_ns = data_dir.stat().st_mtime_ns
+                except FileNotFoundError:
+                    self._scans.pop(data_dir, None)
+                    continue
+
+                scan = self._scans.get(data_dir)
+                if (scan is None) or (scan[0] != mtime_ns):
+                    scan = (
+                        mtime_ns,
+                        [
+                            onnx_path.stem
+                            for onnx_path in data_dir.glob("*.onnx")
+                            if onnx_path.with_name(f"{onnx_path.name}.json").exists()
+                        ],
+                    )
+                    self._scans[data_dir] = scan
+
+                names.update(scan[1])
+
+        return sorted(names)
+
+
+class VoiceCache:
+    """Thread-safe LRU cache of voices that are loaded on first use.
+
+    Each voice has its own lock, so concurrent requests for a voice that isn't
+    loaded yet wait for a single load instead of loading it again.
+    """
+
+    def __init__(self, load_voice: Callable[[str], PiperVoice], max_size: int) -> None:
+        self.max_size = max_size
+        self._load_voice = load_voice
+        self._voices: "OrderedDict[str, PiperVoice]" = OrderedDict()
+        self._load_locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def _get_loaded(self, name: str) -> Optional[PiperVoice]:
+        with self._lock:
+            voice = self._voices.get(name)
+            if voice is not None:
+                self._voices.move_to_end(name)
+
+            return voice
+
+    def _remove_load_lock(self, name: str, load_lock: threading.Lock) -> None:
+        # Must be called with _lock held
+        if self._load_locks.get(name) is load_lock:
+            del self._load_locks[name]
+
+    def get(self, name: str) -> PiperVoice:
+        voice = self._get_loaded(name)
+        if voice is not None:
+            return voice
+
+        with self._lock:
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+
+        with load_lock:
+            # Another request may have loaded the voice while we waited
+            with self._lock:
+                voice = self._voices.get(name)
+                if voice is not None:
+                    self._voices.move_to_end(name)
+                    self._remove_load_lock(name, load_lock)
+                    return voice
+
+            try:
+                voice = self._load_voice(name)
+            except Exception:
+                # Don't keep locks for names that can't be loaded
+                with self._lock:
+                    self._remove_load_lock(name, load_lock)
+
+                raise
+
+            # Add the voice before removing its lock, so no request can find
+            # neither and load the voice again.
+            with self._lock:
+                self._voices[name] = voice
+                self._remove_load_lock(name, load_lock)
+                while len(self._voices) > max(1, self.max_size):
+                    evicted_name, _evicted_voice = self._voices.popitem(last=False)
+                    _LOGGER.debug("Unloaded voice: %s", evicted_name)
+
+            return voice
+
 
 def main() -> None:
     parser = argparse.ArgumentParser()
@@ -32,6 +248,16 @@ def main() -> None:
         "--noise-w", "--noise_w", type=float, help="Phoneme width noise"
     )
     parser.add_argument("--cuda", action="store_true", help="Use GPU")
+    parser.add_argument(
+        "--fp16",
+        action="store_true",
+        help="Run voices converted to float16 on the GPU (requires --cuda)",
+    )
+    parser.add_argument(
+        "--external-data",
+        action="store_true",
+        help="Memory-map voice weights from a separate file, shared between processes",
+    )
     parser.add_argument(
         "--sentence-silence",
         "--sentence_silence",
@@ -39,6 +265,46 @@ def main() -> None:
         default=0.0,
         help="Seconds of silence after each sentence",
     )
+    parser.add_argument(
+        "--output-sample-rate",
+        "--output_sample_rate",
+        type=int,
+        help="Resample audio to this rate in Hertz (default: voice sample rate)",
+    )
+    parser.add_argument(
+        "--synth-workers",
+        "--synth_workers",
+        type=int,
+        default=1,
+        help="Maximum number of concurrent synthesis jobs (default: 1)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        "--batch_size",
+        type=int,
+        default=1,
+        help="Maximum number of sentences to synthesize together (default: 1)",
+    )
+    parser.add_argument(
+        "--max-wait-ms",
+        "--max_wait_ms",
+        type=float,
+        default=10.0,
+        help="Milliseconds to wait for more sentences to batch (default: 10)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of server processes, each with its own voices (requires gunicorn)",
+    )
+    parser.add_argument(
+        "--worker-threads",
+        "--worker_threads",
+        type=int,
+        default=8,
+        help="Request threads per server process with --workers (default: 8)",
+    )
     parser.add_argument(
         "--data-dir",
         "--data_dir",
@@ -56,6 +322,39 @@ def main() -> None:
         action="store_true",
         help="Download latest voices.json during startup",
     )
+    parser.add_argument(
+        "--download-voices",
+        "--download_voices",
+        action="store_true",
+        help="Download voices from voices.json that are requested but missing",
+    )
+    parser.add_argument(
+        "--max-loaded-voices",
+        "--max_loaded_voices",
+        type=int,
+        default=1,
+        help="Number of voices besides --model to keep loaded (default: 1)",
+    )
+    parser.add_argument(
+        "--intra-op-threads",
+        "--intra_op_threads",
+        type=int,
+        default=0,
+        help="Number of onnxruntime threads per synthesis (default: automatic)",
+    )
+    parser.add_argument(
+        "--pin-cores",
+        "--pin_cores",
+        action="store_true",
+        help="Pin phonemizing to E-cores and inference to P-cores (hybrid CPUs)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        "--cache_size",
+        type=int,
+        default=0,
+        help="Number of synthesized WAV files to keep in memory (default: 0)",
+    )
     parser.add_argument(
         "--debug", action="store_true", help="Print DEBUG messages to console"
     )
@@ -66,29 +365,232 @@ def main() -> None:
     if not args.download_dir:
         args.download_dir = args.data_dir[0]
 
-    model_path = Path(args.model)
-    if not model_path.exists():
-        voices_info = get_voices(args.download_dir, update_voices=args.update_voices)
+    if args.fp16 and (not args.cuda):
+        parser.error("--fp16 requires --cuda")
+
+    args.efficiency_cores = None
+    if args.pin_cores:
+        hybrid_cores = get_hybrid_cores()
+        if hybrid_cores is None:
+            _LOGGER.warning("No hybrid CPU detected, ignoring --pin-cores")
+        else:
+            # Threads (including onnxruntime's) inherit this affinity, so only
+            # the phonemizer threads need to move to the efficiency cores.
+            performance_cores, args.efficiency_cores = hybrid_cores
+            _LOGGER.debug(
+                "Performance cores: %s, efficiency cores: %s",
+                sorted(performance_cores),
+                sorted(args.efficiency_cores),
+            )
+            os.sched_setaffinity(0, performance_cores)
 
-        aliases_info: Dict[str, Any] = {}
-        for voice_info in voices_info.values():
-            for voice_alias in voice_info.get("aliases", []):
-                aliases_info[voice_alias] = {"_is_alias": True, **voice_info}
+    if (args.intra_op_threads <= 0) and ((args.workers > 1) or args.efficiency_cores):
+        # Split cores between processes instead of oversubscribing them.
+        # onnxruntime doesn't limit its automatic thread count to our affinity.
+        num_cores = (
+            len(os.sched_getaffinity(0)) if args.efficiency_cores else os.cpu_count()
+        )
+        args.intra_op_threads = max(1, (num_cores or 1) // args.workers)
 
-        voices_info.update(aliases_info)
+    # Load voice info once, so loading a voice later is just a lookup
+    voices_info = add_voice_aliases(
+        get_voices(args.download_dir, update_voices=args.update_voices)
+    )
+
+    model_path = Path(args.model)
+    if not model_path.exists():
         ensure_voice_exists(args.model, args.data_dir, args.download_dir, voices_info)
         args.model, args.config = find_voice(args.model, args.data_dir)
 
-    voice = PiperVoice.load(args.model, config_path=args.config, use_cuda=args.cuda)
+    if args.config is None:
+        args.config = f"{args.model}.json"
+
+    # Convert once here, so worker processes don't all write the same files
+    args.model = str(_convert_model(args, args.model))
+
+    if args.workers > 1:
+        _run_gunicorn(args, voices_info)
+    else:
+        app = create_app(args, voices_info)
+        app.run(host=args.host, port=args.port, threaded=True)
+
+
+def _convert_model(args: argparse.Namespace, model_path: Union[str, Path]) -> Path:
+    """Path of the model converted as requested by --fp16 and --external-data."""
+    if args.fp16:
+        model_path = convert_to_fp16(model_path)
+
+    if args.external_data:
+        model_path = convert_to_external_data(model_path)
+
+    return Path(model_path)
+
+
+def create_app(args: argparse.Namespace, voices_info: Dict[str, Any]) -> Flask:
+    """Load voices and create the Flask app."""
+    sess_options = onnxruntime.SessionOptions()
+    sess_options.graph_optimization_level = (
+        onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    )
+    sess_options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    sess_options.intra_op_num_threads = args.intra_op_threads
+
+    def load_voice_files(
+        model_path: Union[str, Path],
+        config_path: Union[str, Path],
+        convert: bool = True,
+    ) -> PiperVoice:
+        with MODEL_LOAD_SECONDS.time():
+            if convert:
+                model_path = _convert_model(args, model_path)
+
+            _LOGGER.debug("Loading voice: %s", model_path)
+            return PiperVoice.load(
+                model_path,
+                config_path=config_path,
+                use_cuda=args.cuda,
+                sess_options=sess_options,
+            )
+
+    def voice_key(name: str) -> str:
+        # Aliases are old names, so look for files under the current one
+        voice_info = voices_info.get(name)
+        return name if voice_info is None else voice_info.get("key", name)
+
+    def load_voice(name: str) -> PiperVoice:
+        voice_info = voices_info.get(name)
+        key = voice_key(name)
+
+        try:
+            model_path, config_path = find_voice(key, args.data_dir)
+        except ValueError:
+            if (voice_info is None) or (not args.download_voices):
+                raise
+
+            # Only when files are missing, since checking them hashes each one
+            ensure_voice_exists(name, args.data_dir, args.download_dir, voices_info)
+            model_path, config_path = find_voice(key, args.data_dir)
+
+        voice = load_voice_files(model_path, config_path)
+        warm_up(voice)
+
+        return voice
+
+    # Already converted by main()
+    default_voice = load_voice_files(args.model, args.config, convert=False)
+
+    # Requests for the default model by name use the voice that's loaded
+    default_voice_key = voice_key(Path(args.model).stem)
+
     synthesize_args = {
         "speaker_id": args.speaker,
         "length_scale": args.length_scale,
         "noise_scale": args.noise_scale,
         "noise_w": args.noise_w,
-        "sentence_silence": args.sentence_silence,
     }
 
+    # Inference runs on a bounded pool so request threads never oversubscribe
+    # onnxruntime, which already parallelizes each run internally.
+    synth_executor = ThreadPoolExecutor(max_workers=args.synth_workers)
+
+    phonemize_executor: Optional[ThreadPoolExecutor] = None
+    if args.efficiency_cores:
+        phonemize_executor = ThreadPoolExecutor(
+            max_workers=len(args.efficiency_cores),
+            initializer=os.sched_setaffinity,
+            initargs=(0, args.efficiency_cores),
+        )
+
+    batch_scheduler: Optional[BatchScheduler] = None
+    if args.batch_size > 1:
+        batch_scheduler = BatchScheduler(args.batch_size, args.max_wait_ms / 1000)
+
+    def synthesize_ids(voice: PiperVoice, phoneme_ids: List[int]) -> bytes:
+        with SYNTH_SECONDS.time():
+            return voice.synthesize_ids_to_raw(phoneme_ids, **synthesize_args)
+
+    def synthesize_raw(voice: PiperVoice, text: str) -> Iterable[bytes]:
+        """Yield 16-bit mono audio sentence by sentence at the output rate."""
+        sample_rate = voice.config.sample_rate
+        output_sample_rate = args.output_sample_rate or sample_rate
+        silence_bytes = bytes(int(args.sentence_silence * output_sample_rate) * 2)
+
+        def text_to_phoneme_ids() -> List[List[int]]:
+            return [
+                voice.phonemes_to_ids(phonemes) for phonemes in voice.phonemize(text)
+            ]
+
+        if phonemize_executor is not None:
+            sentence_phoneme_ids = phonemize_executor.submit(
+                text_to_phoneme_ids
+            ).result()
+        else:
+            sentence_phoneme_ids = text_to_phoneme_ids()
+
+        audio_futures: Iterable["Future[bytes]"]
+        if batch_scheduler is not None:
+            # Queue all sentences so they can share batches
+            audio_futures = [
+                batch_scheduler.submit(voice, phoneme_ids, **synthesize_args)
+                for phoneme_ids in sentence_phoneme_ids
+            ]
+        else:
+            # One sentence per job so long texts don't starve other requests
+            audio_futures = (
+                synth_executor.submit(synthesize_ids, voice, phoneme_ids)
+                for phoneme_ids in sentence_phoneme_ids
+            )
+
+        for audio_future in audio_futures:
+            audio_bytes = audio_future.result()
+            if output_sample_rate != sample_rate:
+                audio = resample_audio(
+                    np.frombuffer(audio_bytes, dtype=np.int16),
+                    sample_rate,
+                    output_sample_rate,
+                )
+                audio_bytes = np.clip(audio, -32768, 32767).astype(np.int16).tobytes()
+
+            yield audio_bytes + silence_bytes
+
+    def warm_up(voice: PiperVoice) -> None:
+        # Run once before use so the first request doesn't pay for
+        # memory arena growth and kernel selection.
+        _LOGGER.debug("Warming up voice")
+        for _audio_bytes in synthesize_raw(voice, "Warm up."):
+            pass
+
+    warm_up(default_voice)
+    voice_cache = VoiceCache(load_voice, args.max_loaded_voices)
+
+    audio_cache = AudioCache(args.cache_size)
+    model_list = ModelList(args.data_dir)
+
     app = Flask(__name__)
+    if orjson is not None:
+        app.json = OrjsonProvider(app)
+
+    @app.route("/metrics", methods=["GET"])
+    def app_metrics() -> Any:
+        if (args.workers > 1) and (not is_multiprocess()):
+            # Each process would only report the requests it served
+            return (
+                jsonify(
+                    {"error": "Set PROMETHEUS_MULTIPROC_DIR for metrics with --workers"}
+                ),
+                404,
+            )
+
+        metrics = generate_metrics(multiprocess=args.workers > 1)
+        if metrics is None:
+            return jsonify({"error": "prometheus_client is not installed"}), 404
+
+        metrics_bytes, content_type = metrics
+        return metrics_bytes, 200, {"Content-Type": content_type}
+
+    @app.route("/models", methods=["GET"])
+    def app_models() -> Any:
+        return jsonify({"available_models": model_list.get()})
 
     @app.route("/synthesize", methods=["POST"])
     def app_synthesize() -> Any:
@@ -101,18 +603,95 @@ def main() -> None:
         if not text:
             return jsonify({"error": "No text provided"}), 400
 
-        _LOGGER.debug("Synthesizing text: %s", text)
-        with io.BytesIO() as wav_io:
-            with wave.open(wav_io, "wb") as wav_file:
-                voice.synthesize(text, wav_file, **synthesize_args)
+        voice_name = data.get("voice") or None
+        if voice_name is not None:
+            voice_name = str(voice_name)
+            if Path(voice_name).name != voice_name:
+                return jsonify({"error": "Invalid voice name"}), 400
 
-            return wav_io.getvalue(), 200, {'Content-Type': 'audio/wav'}
+            if voice_key(voice_name) == default_voice_key:
+                voice_name = None
+
+        cache_key = AudioCache.make_key(
+            {
+                "model": voice_name or str(args.model),
+                "output_sample_rate": args.output_sample_rate,
+                "sentence_silence": args.sentence_silence,
+                "text": text,
+                **synthesize_args,
+            }
+        )
+        wav_bytes = audio_cache.get(cache_key)
+        if wav_bytes is not None:
+            CACHE_HITS.inc()
+            return wav_bytes, 200, {"Content-Type": "audio/wav"}
+
+        if audio_cache.max_size > 0:
+            CACHE_MISSES.inc()
+
+        if voice_name is None:
+            voice = default_voice
+        else:
+            try:
+                voice = voice_cache.get(voice_name)
+            except (ValueError, VoiceNotFoundError):
+                return jsonify({"error": f"Voice not found: {voice_name}"}), 404
+
+        output_sample_rate = args.output_sample_rate or voice.config.sample_rate
+
+        def stream_wav() -> Iterable[bytes]:
+            # Audio is sent as each sentence is synthesized, so the header
+            # can't contain the final size.
+            _LOGGER.debug("Synthesizing text: %s", text)
+            yield wav_header(output_sample_rate)
+
+            cache_chunks: List[bytes] = []
+            for audio_bytes in synthesize_raw(voice, text):
+                if audio_cache.max_size > 0:
+                    cache_chunks.append(audio_bytes)
+
+                yield audio_bytes
+
+            if audio_cache.max_size > 0:
+                audio_data = b"".join(cache_chunks)
+                audio_cache.put(
+                    cache_key,
+                    wav_header(output_sample_rate, len(audio_data)) + audio_data,
+                )
+
+        return Response(stream_wav(), mimetype="audio/wav")
 
     @app.route("/", methods=["GET"])
     def app_root() -> str:
         return "Piper Voice Server. Use POST /synthesize with JSON body {'text': 'your text here'} to synthesize speech."
 
-    app.run(host=args.host, port=args.port)
+    return app
+
+
+def _run_gunicorn(args: argparse.Namespace, voices_info: Dict[str, Any]) -> None:
+    """Serve the app from multiple gunicorn worker processes."""
+    from gunicorn.app.base import BaseApplication
+
+    class PiperApplication(BaseApplication):
+        def load_config(self) -> None:
+            self.cfg.set("bind", f"{args.host}:{args.port}")
+            self.cfg.set("workers", args.workers)
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("threads", args.worker_threads)
+
+            # onnxruntime sessions can't be shared across fork, so each
+            # worker loads its own voices.
+            self.cfg.set("preload_app", False)
+            self.cfg.set("child_exit", _child_exit)
+
+        def load(self) -> Flask:
+            return create_app(args, voices_info)
+
+    def _child_exit(_server: Any, worker: Any) -> None:
+        mark_process_dead(worker.pid)
+
+    clear_multiprocess_dir()
+    PiperApplication().run()
 
 
 if __name__ == "__main__":
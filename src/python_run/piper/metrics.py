@@ -0,0 +1,108 @@
+"""Prometheus metrics for the HTTP server.
+
+Metrics do nothing if prometheus_client isn't installed. To collect metrics
+from several server processes, PROMETHEUS_MULTIPROC_DIR must be set before
+they start.
+"""
+import os
+from contextlib import nullcontext
+from pathlib import Path
+from typing import Any, ContextManager, Optional, Tuple
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None  # type: ignore
+
+_SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10)
+_BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32)
+
+
+class _NullMetric:
+    """Stands in for a metric when prometheus_client is missing."""
+
+    def inc(self, amount: float = 1) -> None:
+        pass
+
+    def observe(self, amount: float) -> None:
+        pass
+
+    def time(self) -> ContextManager[Any]:
+        return nullcontext()
+
+
+def _counter(name: str, documentation: str) -> Any:
+    if prometheus_client is None:
+        return _NullMetric()
+
+    return prometheus_client.Counter(name, documentation)
+
+
+def _histogram(
+    name: str, documentation: str, buckets: Tuple[float, ...] = _SECONDS_BUCKETS
+) -> Any:
+    if prometheus_client is None:
+        return _NullMetric()
+
+    return prometheus_client.Histogram(name, documentation, buckets=buckets)
+
+
+SYNTH_SECONDS = _histogram(
+    "piper_synth_seconds", "Time spent in one inference run (sentence or batch)"
+)
+MODEL_LOAD_SECONDS = _histogram(
+    "piper_model_load_seconds", "Time spent converting and loading a voice"
+)
+BATCH_SIZE = _histogram(
+    "piper_batch_size", "Sentences per batched inference run", _BATCH_SIZE_BUCKETS
+)
+BATCH_TRIM_FAILURES = _counter(
+    "piper_batch_trim_failures",
+    "Batched utterances returned with padding because its end wasn't found",
+)
+CACHE_HITS = _counter("piper_cache_hits", "Requests answered from the audio cache")
+CACHE_MISSES = _counter("piper_cache_misses", "Requests that had to be synthesized")
+
+
+def is_multiprocess() -> bool:
+    """True if metrics are shared between processes."""
+    return (prometheus_client is not None) and bool(
+        os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    )
+
+
+def clear_multiprocess_dir() -> None:
+    """Delete metrics left behind by processes from an earlier run."""
+    if is_multiprocess():
+        for db_path in Path(os.environ["PROMETHEUS_MULTIPROC_DIR"]).glob("*.db"):
+            db_path.unlink()
+
+
+def mark_process_dead(pid: int) -> None:
+    """Drop live values (gauges) of an exited process."""
+    if is_multiprocess():
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(pid)
+
+
+def generate_metrics(multiprocess: bool = False) -> Optional[Tuple[bytes, str]]:
+    """Metrics in the Prometheus text format and their content type.
+
+    With multiprocess, metrics are combined from all processes sharing
+    PROMETHEUS_MULTIPROC_DIR.
+    """
+    if prometheus_client is None:
+        return None
+
+    registry = prometheus_client.REGISTRY
+    if multiprocess:
+        from prometheus_client import multiprocess as prometheus_multiprocess
+
+        registry = prometheus_client.CollectorRegistry()
+        prometheus_multiprocess.MultiProcessCollector(registry)
+
+    return (
+        prometheus_client.generate_latest(registry),
+        prometheus_client.CONTENT_TYPE_LATEST,
+    )
@@ -1,4 +1,10 @@
 """Utilities"""
+import os
+from functools import lru_cache
+from math import gcd
+from pathlib import Path
+from typing import Optional, Set, Tuple
+
 import numpy as np
 
 
@@ -10,3 +16,85 @@ def audio_float_to_int16(
     audio_norm = np.clip(audio_norm, -max_wav_value, max_wav_value)
     audio_norm = audio_norm.astype("int16")
     return audio_norm
+
+
+@lru_cache(maxsize=8)
+def _polyphase_filter(up: int, down: int) -> np.ndarray:
+    """Kaiser-windowed sinc low-pass filter split into up phases (up x taps)"""
+    max_rate = max(up, down)
+    half_len = 10 * max_rate
+    t = np.arange(-half_len, half_len + 1, dtype=np.float64)
+    taps = np.sinc(t / max_rate) * np.kaiser(len(t), 5.0)
+    taps *= up / np.sum(taps)
+
+    taps_per_phase = -(-len(taps) // up)
+    taps = np.pad(taps, (0, (taps_per_phase * up) - len(taps)))
+
+    # phases[p, k] = taps[p + (k * up)]
+    return np.ascontiguousarray(taps.reshape(taps_per_phase, up).T, dtype=np.float32)
+
+
+def resample_audio(audio: np.ndarray, orig_rate: int, new_rate: int) -> np.ndarray:
+    """Resample mono audio with a polyphase FIR filter (float32 output)"""
+    audio = np.asarray(audio, dtype=np.float32)
+    if orig_rate == new_rate:
+        return audio
+
+    divisor = gcd(orig_rate, new_rate)
+    up, down = new_rate // divisor, orig_rate // divisor
+    phases = _polyphase_filter(up, down)
+    taps_per_phase = phases.shape[1]
+    half_len = 10 * max(up, down)
+
+    # Position of each output sample in the (virtually) upsampled signal,
+    # shifted by the filter delay.
+    num_samples = -(-len(audio) * up // down)
+    positions = (np.arange(num_samples, dtype=np.int64) * down) + half_len
+    indexes = (positions // up)[:, None] - np.arange(taps_per_phase)[None, :]
+
+    padded = np.pad(audio, (taps_per_phase, taps_per_phase))
+    return np.einsum(
+        "mk,mk->m", phases[positions % up], padded[indexes + taps_per_phase]
+    )
+
+
+def _parse_cpu_list(cpu_list: str) -> Set[int]:
+    """Parse a Linux CPU list like 0-7,16"""
+    cpus: Set[int] = set()
+    for cpu_range in cpu_list.strip().split(","):
+        if not cpu_range:
+            continue
+
+        first, _, last = cpu_range.partition("-")
+        cpus.update(range(int(first), int(last or first) + 1))
+
+    return cpus
+
+
+def get_hybrid_cores(
+    devices_dir: Path = Path("/sys/devices"),
+) -> Optional[Tuple[Set[int], Set[int]]]:
+    """Performance and efficiency cores this process may run on.
+
+    Returns None unless the CPU (as reported by Linux) has both kinds.
+    """
+    if not hasattr(os, "sched_getaffinity"):
+        return None
+
+    try:
+        performance_cores = _parse_cpu_list(
+            (devices_dir / "cpu_core" / "cpus").read_text(encoding="utf-8")
+        )
+        efficiency_cores = _parse_cpu_list(
+            (devices_dir / "cpu_atom" / "cpus").read_text(encoding="utf-8")
+        )
+    except (OSError, ValueError):
+        return None
+
+    allowed_cores = os.sched_getaffinity(0)
+    performance_cores &= allowed_cores
+    efficiency_cores &= allowed_cores
+    if (not performance_cores) or (not efficiency_cores):
+        return None
+
+    return performance_cores, efficiency_cores
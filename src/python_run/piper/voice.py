@@ -3,18 +3,24 @@ import logging
 import wave
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, Union
 
 import numpy as np
 import onnxruntime
 from piper_phonemize import phonemize_codepoints, phonemize_espeak, tashkeel_run
 
 from .config import PhonemeType, PiperConfig
-from .const import BOS, EOS, PAD
+from .const import BOS, EOS, HOP_LENGTH, PAD
 from .util import audio_float_to_int16
 
 _LOGGER = logging.getLogger(__name__)
 
+# Padding response is periodic to within this fraction of the peak amplitude
+_PERIOD_TOLERANCE = 1e-4
+
+# Samples at the end of a batch where convolution padding breaks the period
+_MAX_EDGE_SAMPLES = 16 * HOP_LENGTH
+
 
 @dataclass
 class PiperVoice:
@@ -26,6 +32,7 @@ class PiperVoice:
         model_path: Union[str, Path],
         config_path: Optional[Union[str, Path]] = None,
         use_cuda: bool = False,
+        sess_options: Optional[onnxruntime.SessionOptions] = None,
     ) -> "PiperVoice":
         """Load an ONNX model and config."""
         if config_path is None:
@@ -40,7 +47,8 @@ class PiperVoice:
                 (
                     "CUDAExecutionProvider",
                     {"cudnn_conv_algo_search": "HEURISTIC"},
-                )
+                ),
+                "CPUExecutionProvider",
             ]
         else:
             providers = ["CPUExecutionProvider"]
@@ -49,7 +57,7 @@ class PiperVoice:
             config=PiperConfig.from_dict(config_dict),
             session=onnxruntime.InferenceSession(
                 str(model_path),
-                sess_options=onnxruntime.SessionOptions(),
+                sess_options=sess_options or onnxruntime.SessionOptions(),
                 providers=providers,
             ),
         )
@@ -146,6 +154,92 @@ class PiperVoice:
         noise_w: Optional[float] = None,
     ) -> bytes:
         """Synthesize raw audio from phoneme ids."""
+        phoneme_ids_array = np.expand_dims(np.array(phoneme_ids, dtype=np.int64), 0)
+        phoneme_ids_lengths = np.array([phoneme_ids_array.shape[1]], dtype=np.int64)
+        args = self._inference_args(
+            phoneme_ids_array,
+            phoneme_ids_lengths,
+            speaker_id=speaker_id,
+            length_scale=length_scale,
+            noise_scale=noise_scale,
+            noise_w=noise_w,
+        )
+
+        # Synthesize through Onnx
+        audio = self.session.run(None, args)[0].squeeze((0, 1))
+        audio = audio_float_to_int16(audio.squeeze())
+        return audio.tobytes()
+
+    def synthesize_ids_to_raw_batch(
+        self,
+        phoneme_ids_batch: Sequence[List[int]],
+        speaker_id: Optional[int] = None,
+        length_scale: Optional[float] = None,
+        noise_scale: Optional[float] = None,
+        noise_w: Optional[float] = None,
+    ) -> Tuple[List[bytes], int]:
+        """Synthesize raw audio for several utterances in one inference run.
+
+        Shorter utterances are padded. Since models don't output audio
+        lengths, their audio is cut where the decoder's response to the
+        padding begins, which may leave a short, quiet tail.
+
+        Returns the audio and the number of utterances whose padding wasn't
+        found, which are returned untrimmed.
+        """
+        phoneme_ids_lengths = np.fromiter(
+            (len(phoneme_ids) for phoneme_ids in phoneme_ids_batch),
+            dtype=np.int64,
+            count=len(phoneme_ids_batch),
+        )
+        max_length = int(phoneme_ids_lengths.max())
+        pad_id = self.config.phoneme_id_map[PAD][0]
+        phoneme_ids_array = np.full(
+            (len(phoneme_ids_batch), max_length), pad_id, dtype=np.int64
+        )
+        for i, phoneme_ids in enumerate(phoneme_ids_batch):
+            phoneme_ids_array[i, : len(phoneme_ids)] = phoneme_ids
+        args = self._inference_args(
+            phoneme_ids_array,
+            phoneme_ids_lengths,
+            speaker_id=speaker_id,
+            length_scale=length_scale,
+            noise_scale=noise_scale,
+            noise_w=noise_w,
+        )
+
+        # Synthesize through Onnx
+        audio_batch = self.session.run(None, args)[0].reshape(
+            len(phoneme_ids_batch), -1
+        )
+
+        audio_bytes_batch: List[bytes] = []
+        num_untrimmed = 0
+        for phoneme_ids, audio in zip(phoneme_ids_batch, audio_batch):
+            if len(phoneme_ids) < max_length:
+                trimmed_audio = _trim_padding_audio(audio)
+                if trimmed_audio is None:
+                    num_untrimmed += 1
+                    _LOGGER.debug(
+                        "No padding found in batched utterance, keeping %s sample(s)",
+                        len(audio),
+                    )
+                else:
+                    audio = trimmed_audio
+
+            audio_bytes_batch.append(audio_float_to_int16(audio).tobytes())
+
+        return audio_bytes_batch, num_untrimmed
+
+    def _inference_args(
+        self,
+        phoneme_ids_array: np.ndarray,
+        phoneme_ids_lengths: np.ndarray,
+        speaker_id: Optional[int] = None,
+        length_scale: Optional[float] = None,
+        noise_scale: Optional[float] = None,
+        noise_w: Optional[float] = None,
+    ) -> Dict[str, np.ndarray]:
         if length_scale is None:
             length_scale = self.config.length_scale
 
@@ -155,8 +249,6 @@ class PiperVoice:
         if noise_w is None:
             noise_w = self.config.noise_w
 
-        phoneme_ids_array = np.expand_dims(np.array(phoneme_ids, dtype=np.int64), 0)
-        phoneme_ids_lengths = np.array([phoneme_ids_array.shape[1]], dtype=np.int64)
         scales = np.array(
             [noise_scale, length_scale, noise_w],
             dtype=np.float32,
@@ -165,7 +257,7 @@ class PiperVoice:
         args = {
             "input": phoneme_ids_array,
             "input_lengths": phoneme_ids_lengths,
-            "scales": scales
+            "scales": scales,
         }
 
         if self.config.num_speakers <= 1:
@@ -176,10 +268,36 @@ class PiperVoice:
             speaker_id = 0
 
         if speaker_id is not None:
-            sid = np.array([speaker_id], dtype=np.int64)
+            sid = np.full(len(phoneme_ids_lengths), speaker_id, dtype=np.int64)
             args["sid"] = sid
 
-        # Synthesize through Onnx
-        audio = self.session.run(None, args, )[0].squeeze((0, 1))
-        audio = audio_float_to_int16(audio.squeeze())
-        return audio.tobytes()
+        return args
+
+
+def _trim_padding_audio(audio: np.ndarray) -> Optional[np.ndarray]:
+    """Cut audio generated for padding at the end of a batched utterance.
+
+    The decoder's response to padding repeats every hop, so the utterance
+    ends before a long run of periodic samples that lasts until the end of
+    the batch. Samples at the very end are skipped since convolution padding
+    breaks the period there.
+
+    Returns None if no such run is found.
+    """
+    tolerance = _PERIOD_TOLERANCE * max(float(np.max(np.abs(audio))), 1e-6)
+    changed = np.abs(audio[HOP_LENGTH:] - audio[:-HOP_LENGTH]) > tolerance
+    changed_idxs = np.flatnonzero(changed)
+    if len(changed_idxs) < 2:
+        return None
+
+    gaps = np.flatnonzero(np.diff(changed_idxs) > HOP_LENGTH)
+    if len(gaps) < 1:
+        return None
+
+    # A periodic run that stops well before the end is a pause, not padding
+    run_end_idx = changed_idxs[gaps[-1] + 1]
+    if (len(audio) - run_end_idx) > _MAX_EDGE_SAMPLES:
+        return None
+
+    end_idx = changed_idxs[gaps[-1]] + HOP_LENGTH + 1
+    return audio[:end_idx]
@@ -0,0 +1,173 @@
+"""Tests for trimming batched audio and grouping batches by length."""
+from typing import List
+
+import numpy as np
+import onnxruntime
+import pytest
+
+from piper.batch import _BatchItem
+from piper.const import HOP_LENGTH
+from piper.voice import _trim_padding_audio
+
+onnx = pytest.importorskip("onnx")
+from onnx import TensorProto, helper, numpy_helper  # noqa: E402
+
+_CHANNELS = 8
+
+
+def _make_decoder() -> onnxruntime.InferenceSession:
+    """HiFi-GAN-shaped decoder with random weights: 2 x 16 upsampling."""
+    rng = np.random.default_rng(1234)
+    nodes: List[onnx.NodeProto] = []
+    initializers: List[onnx.TensorProto] = []
+
+    def weight(name: str, *shape: int) -> str:
+        initializers.append(
+            numpy_helper.from_array(
+                (rng.standard_normal(shape) / np.sqrt(shape[1] * shape[2])).astype(
+                    np.float32
+                ),
+                name,
+            )
+        )
+        return name
+
+    def bias(name: str, size: int) -> str:
+        initializers.append(
+            numpy_helper.from_array(
+                (0.1 * rng.standard_normal(size)).astype(np.float32), name
+            )
+        )
+        return name
+
+    value = "z"
+    for i in range(2):
+        nodes.append(
+            helper.make_node(
+                "Conv",
+                [
+                    value,
+                    weight(f"conv{i}.w", _CHANNELS, _CHANNELS, 7),
+                    bias(f"conv{i}.b", _CHANNELS),
+                ],
+                [f"conv{i}"],
+                pads=[3, 3],
+            )
+        )
+        nodes.append(
+            helper.make_node("LeakyRelu", [f"conv{i}"], [f"act{i}"], alpha=0.1)
+        )
+        nodes.append(
+            helper.make_node(
+                "ConvTranspose",
+                [
+                    f"act{i}",
+                    weight(f"up{i}.w", _CHANNELS, _CHANNELS, 32),
+                    bias(f"up{i}.b", _CHANNELS),
+                ],
+                [f"up{i}"],
+                strides=[16],
+                pads=[8, 8],
+            )
+        )
+        value = f"up{i}"
+
+    nodes.append(
+        helper.make_node(
+            "Conv",
+            [value, weight("post.w", 1, _CHANNELS, 7), bias("post.b", 1)],
+            ["post"],
+            pads=[3, 3],
+        )
+    )
+    nodes.append(helper.make_node("Tanh", ["post"], ["audio"]))
+
+    graph = helper.make_graph(
+        nodes,
+        "decoder",
+        [helper.make_tensor_value_info("z", TensorProto.FLOAT, [1, _CHANNELS, None])],
+        [helper.make_tensor_value_info("audio", TensorProto.FLOAT, [1, 1, None])],
+        initializers,
+    )
+    model = helper.make_model(
+        graph, opset_imports=[helper.make_opsetid("", 13)], ir_version=8
+    )
+
+    return onnxruntime.InferenceSession(
+        model.SerializeToString(), providers=["CPUExecutionProvider"]
+    )
+
+
+@pytest.fixture(scope="module")
+def decoder() -> onnxruntime.InferenceSession:
+    return _make_decoder()
+
+
+def _decode(decoder: onnxruntime.InferenceSession, *frames: np.ndarray) -> np.ndarray:
+    z = np.concatenate(frames, axis=1)[np.newaxis].astype(np.float32)
+    return decoder.run(None, {"z": z})[0].squeeze()
+
+
+def _speech(num_frames: int, seed: int) -> np.ndarray:
+    return np.random.default_rng(seed).standard_normal((_CHANNELS, num_frames))
+
+
+def _padding(num_frames: int) -> np.ndarray:
+    # Latent frames past an utterance's length are masked to zero
+    return np.zeros((_CHANNELS, num_frames))
+
+
+def test_trim_padding(decoder) -> None:
+    speech = _speech(40, seed=0)
+    solo_audio = _decode(decoder, speech)
+    padded_audio = _decode(decoder, speech, _padding(60))
+    assert len(padded_audio) == 100 * HOP_LENGTH
+
+    trimmed_audio = _trim_padding_audio(padded_audio)
+    assert trimmed_audio is not None
+
+    # Never cuts into the utterance, and leaves only a short tail
+    assert len(solo_audio) <= len(trimmed_audio) <= len(solo_audio) + (8 * HOP_LENGTH)
+
+    # Away from the end, audio matches the utterance synthesized alone
+    body_length = len(solo_audio) - (4 * HOP_LENGTH)
+    np.testing.assert_allclose(
+        trimmed_audio[:body_length], solo_audio[:body_length], atol=1e-5
+    )
+
+
+def test_trim_padding_with_noise(decoder) -> None:
+    """Padding is still found when the period isn't bit-exact (float16, GPU)."""
+    speech = _speech(40, seed=1)
+    padded_audio = _decode(decoder, speech, _padding(60))
+    noise = np.random.default_rng(2).standard_normal(len(padded_audio))
+    noisy_audio = padded_audio + (1e-5 * np.max(np.abs(padded_audio)) * noise)
+
+    trimmed_audio = _trim_padding_audio(noisy_audio.astype(np.float32))
+    assert trimmed_audio is not None
+    assert len(trimmed_audio) <= 50 * HOP_LENGTH
+
+
+def test_trim_without_padding(decoder) -> None:
+    assert _trim_padding_audio(_decode(decoder, _speech(40, seed=3))) is None
+
+
+def test_trim_keeps_pause(decoder) -> None:
+    """A pause followed by more speech is not mistaken for padding."""
+    audio = _decode(decoder, _speech(20, seed=4), _padding(30), _speech(40, seed=5))
+    assert _trim_padding_audio(audio) is None
+
+
+def test_batch_by_length() -> None:
+    def item(num_phoneme_ids: int) -> _BatchItem:
+        return _BatchItem(
+            voice=None,  # type: ignore[arg-type]
+            phoneme_ids=[0] * num_phoneme_ids,
+            speaker_id=None,
+            length_scale=None,
+            noise_scale=None,
+            noise_w=None,
+        )
+
+    assert item(100).can_batch_with(item(110))
+    assert not item(100).can_batch_with(item(200))
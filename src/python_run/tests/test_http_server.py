@@ -0,0 +1,124 @@
+"""Tests for the HTTP server's caches."""
+import threading
+import time
+from typing import Any, List
+
+import pytest
+
+pytest.importorskip("flask")
+
+from piper.http_server import AudioCache, VoiceCache  # noqa: E402
+
+
+class _SlowLock:
+    """Lock that pauses one thread after each release, so others run first."""
+
+    def __init__(self, slow_thread: int) -> None:
+        self._lock = threading.Lock()
+        self._slow_thread = slow_thread
+
+    def __enter__(self) -> None:
+        self._lock.acquire()
+
+    def __exit__(self, *args: Any) -> None:
+        self._lock.release()
+        if threading.get_ident() == self._slow_thread:
+            time.sleep(0.05)
+
+
+def test_audio_cache_evicts_least_recently_used() -> None:
+    cache = AudioCache(max_size=2)
+    cache.put("a", b"A")
+    cache.put("b", b"B")
+
+    # Reading "a" makes "b" the least recently used
+    assert cache.get("a") == b"A"
+    cache.put("c", b"C")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == b"A"
+    assert cache.get("c") == b"C"
+
+
+def test_audio_cache_disabled() -> None:
+    cache = AudioCache(max_size=0)
+    cache.put("a", b"A")
+    assert cache.get("a") is None
+
+
+def test_audio_cache_key() -> None:
+    key = AudioCache.make_key({"text": "Hello", "length_scale": 1.0})
+    assert key == AudioCache.make_key({"length_scale": 1.0, "text": "Hello"})
+    assert key != AudioCache.make_key({"text": "Hello", "length_scale": 1.5})
+
+
+def test_voice_cache_loads_once() -> None:
+    """A request arriving right as a load finishes doesn't load the voice again."""
+    loads: List[str] = []
+    voices: List[Any] = []
+    requests: List[threading.Thread] = []
+
+    def load_voice(name: str) -> Any:
+        loads.append(name)
+        return object()
+
+    cache = VoiceCache(load_voice, max_size=1)
+
+    class LoadLocks(dict):
+        def __delitem__(self, name: str) -> None:
+            super().__delitem__(name)
+            if not requests:
+                request = threading.Thread(
+                    target=lambda: voices.append(cache.get(name))
+                )
+                request.start()
+                requests.append(request)
+
+    cache._lock = _SlowLock(threading.get_ident())  # type: ignore[assignment]
+    cache._load_locks = LoadLocks()
+    voices.append(cache.get("voice"))
+    requests[0].join()
+
+    assert loads == ["voice"]
+    assert voices[0] is voices[1]
+    assert not cache._load_locks
+
+
+def test_voice_cache_concurrent_requests() -> None:
+    loads: List[str] = []
+
+    def load_voice(name: str) -> Any:
+        loads.append(name)
+        time.sleep(0.05)
+        return object()
+
+    cache = VoiceCache(load_voice, max_size=1)
+    voices: List[Any] = []
+
+    # Requests keep arriving during and right after the load
+    threads = [
+        threading.Thread(target=lambda: voices.append(cache.get("voice")))
+        for _ in range(100)
+    ]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.001)
+
+    for thread in threads:
+        thread.join()
+
+    assert loads == ["voice"]
+    assert all(voice is voices[0] for voice in voices)
+    assert not cache._load_locks
+
+
+def test_voice_cache_forgets_failed_loads() -> None:
+    def load_voice(name: str) -> Any:
+        raise ValueError(name)
+
+    cache = VoiceCache(load_voice, max_size=1)
+    for i in range(10):
+        with pytest.raises(ValueError):
+            cache.get(f"missing-{i}")
+
+    assert not cache._load_locks
@@ -0,0 +1,47 @@
+"""Tests for audio resampling."""
+import numpy as np
+import pytest
+
+from piper.util import resample_audio
+
+
+def _sine(frequency: float, sample_rate: int, seconds: float = 1.0) -> np.ndarray:
+    t = np.arange(int(sample_rate * seconds)) / sample_rate
+    return np.sin(2 * np.pi * frequency * t).astype(np.float32)
+
+
+@pytest.mark.parametrize(
+    "orig_rate,new_rate,num_samples,expected_samples",
+    [
+        (22050, 8000, 22050, 8000),
+        (22050, 16000, 22050, 16000),
+        (16000, 22050, 1000, 1379),
+        (22050, 44100, 100, 200),
+        (22050, 22050, 123, 123),
+    ],
+)
+def test_resample_length(
+    orig_rate: int, new_rate: int, num_samples: int, expected_samples: int
+) -> None:
+    audio = np.zeros(num_samples, dtype=np.float32)
+    assert len(resample_audio(audio, orig_rate, new_rate)) == expected_samples
+
+
+@pytest.mark.parametrize("orig_rate,new_rate", [(22050, 8000), (16000, 22050)])
+def test_resample_sine(orig_rate: int, new_rate: int) -> None:
+    audio = resample_audio(_sine(1000, orig_rate), orig_rate, new_rate)
+
+    spectrum = np.abs(np.fft.rfft(audio * np.hanning(len(audio))))
+    frequencies = np.fft.rfftfreq(len(audio), 1 / new_rate)
+    assert abs(frequencies[np.argmax(spectrum)] - 1000) <= 2
+
+    # Away from the edges, amplitude is unchanged
+    middle = audio[len(audio) // 4 : -len(audio) // 4]
+    assert np.max(np.abs(middle)) == pytest.approx(1.0, abs=0.01)
+
+
+def test_resample_removes_aliasing() -> None:
+    """Frequencies above the new Nyquist rate are filtered out."""
+    audio = resample_audio(_sine(6000, 22050), 22050, 8000)
+    middle = audio[len(audio) // 4 : -len(audio) // 4]
+    assert np.sqrt(np.mean(middle**2)) < 0.01